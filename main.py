@@ -1,12 +1,16 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
-import random
 import aiosqlite
+import numpy as np
+import orjson
 import contextlib
+import logging
+import sqlite3
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
 origins = ["*"]
 app.add_middleware(
@@ -18,69 +22,172 @@ app.add_middleware(
 )
 
 DB_PATH = "aviator.db"
+# Фондық жазушы жинаған өзгерістерді SQLite-қа жіберу аралығы (сек)
+FLUSH_INTERVAL = 0.1
+# Жазу сәтсіз болғанда келесі талпынысқа дейінгі кідіріс (сек)
+WRITE_RETRY_DELAY = 1.0
 
 # ===================== DATABASE =====================
 
+# Сұраулар мәтіні тұрақты: sqlite3 оларды байланыстың statement cache-інде бір рет компиляциялайды
+SQL_LOAD_BALANCES = "SELECT telegram_id, balance FROM users"
+SQL_SAVE_BALANCE = "INSERT INTO users (telegram_id, balance) VALUES (?, ?) ON CONFLICT(telegram_id) DO UPDATE SET balance = excluded.balance"
+SQL_INSERT_BET = "INSERT INTO bets (telegram_id, amount) VALUES (?, ?)"
+SQL_CASHOUT_BET = "UPDATE bets SET cashed_out = 1, multiplier = ?2 WHERE telegram_id = ?1 AND cashed_out = 0"
+SQL_CLEAR_BETS = "DELETE FROM bets"
+# db_writer операциясының түрі -> SQL (балансты flush_writes бөлек біріктіреді)
+WRITE_SQL = {
+    "bet": SQL_INSERT_BET,
+    "cashout": SQL_CASHOUT_BET,
+    "clear": SQL_CLEAR_BETS,
+}
+STATEMENT_CACHE_SIZE = 256
+
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id TEXT PRIMARY KEY,
-            balance REAL DEFAULT 0
-        )
-        """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS bets (
-            telegram_id TEXT,
-            amount REAL,
-            cashed_out INTEGER DEFAULT 0,
-            multiplier REAL DEFAULT 1.0
-        )
-        """)
-        await db.commit()
+    # Бір ортақ байланыс: әр сұранысқа жаңа aiosqlite ағынын ашпаймыз
+    db = app.state.db = await aiosqlite.connect(DB_PATH, cached_statements=STATEMENT_CACHE_SIZE)
+    # WAL: бір commit = бір fsync, оқушылар жазушыны күтпейді
+    await db.execute("PRAGMA journal_mode=WAL")
+    # Базаны тек осы процесс қолданады: құлыпты бір рет алып, әр сұраныстағы fcntl-ды алып тастаймыз
+    await db.execute("PRAGMA locking_mode=EXCLUSIVE")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA cache_size=-64000")
+    await db.execute("PRAGMA busy_timeout=5000")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id TEXT PRIMARY KEY,
+        balance REAL DEFAULT 0
+    )
+    """)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS bets (
+        telegram_id TEXT,
+        amount REAL,
+        cashed_out INTEGER DEFAULT 0,
+        multiplier REAL DEFAULT 1.0
+    )
+    """)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bets_tid_active ON bets(telegram_id) WHERE cashed_out = 0"
+    )
+    await db.commit()
+    balances.update(await db.execute_fetchall(SQL_LOAD_BALANCES))
+
+# Баланстардың негізгі көзі — жад; SQLite-қа db_writer арқылы жазылады
+balances = {}
+# Осы раундтағы белсенді ставкалар: telegram_id -> сома
+round_bets = {}
+# db_writer кезегі: (түрі, telegram_id, мән) немесе ("clear",), None — тоқтау белгісі
+write_queue = asyncio.Queue()
+
+def set_balance(telegram_id, balance):
+    balances[telegram_id] = balance
+    write_queue.put_nowait(("balance", telegram_id, balance))
+
+async def flush_writes(ops):
+    # Барлық операция бір транзакцияда: ставка мен баланс бірге commit болады.
+    # Ставкалар ретімен, қатар тұрған бір түрлі операциялар бір executemany-ге жиналады.
+    if not ops:
+        return
+    db = app.state.db
+    latest = {}
+    run_sql, run_rows = None, []
+    for kind, *args in ops:
+        if kind == "balance":
+            latest[args[0]] = args[1]
+            continue
+        sql = WRITE_SQL[kind]
+        if sql is not run_sql and run_rows:
+            await db.executemany(run_sql, run_rows)
+            run_rows = []
+        run_sql = sql
+        run_rows.append(args)
+    if run_rows:
+        await db.executemany(run_sql, run_rows)
+    if latest:
+        await db.executemany(SQL_SAVE_BALANCE, list(latest.items()))
+    await db.commit()
+
+async def try_flush(ops):
+    # Сәтсіз транзакцияны кері қайтарамыз; қатені қайтарады (None — ops жазылды)
+    try:
+        await flush_writes(ops)
+        return None
+    except Exception as exc:
+        logger.exception("db_writer: %d операцияны жазу сәтсіз", len(ops))
+        with contextlib.suppress(Exception):
+            await app.state.db.rollback()
+        return exc
+
+def is_bad_op(op, exc):
+    # Баланс — абсолютті мән, оны ешқашан тастамаймыз.
+    # Тек операцияның өзі жарамсыз болса (белгісіз түр, IntegrityError) тасталады.
+    if op[0] == "balance":
+        return False
+    return op[0] not in WRITE_SQL or isinstance(exc, sqlite3.IntegrityError)
+
+async def flush_one_by_one(ops):
+    # Пакет құласа, операцияларды ретімен жеке жазамыз. Жарамсыз операция тасталады;
+    # уақытша қатеде (диск толы, I/O) тоқтаймыз да, қалғанын ретімен келесі талпынысқа қалдырамыз —
+    # әйтпесе ескі баланс жаңасының үстінен кейін жазылып кетуі мүмкін.
+    for i, op in enumerate(ops):
+        exc = await try_flush([op])
+        if exc is None:
+            continue
+        if is_bad_op(op, exc):
+            logger.error("db_writer: жарамсыз операция тасталды: %r", op)
+            continue
+        return ops[i:]
+    return []
+
+async def db_writer():
+    # FLUSH_INTERVAL ішінде жиналған өзгерістер бір executemany + бір commit болып түседі.
+    # Қате жазушыны тоқтатпайды: жазылмаған операциялар pending-те қалып, қайта жіберіледі.
+    pending = []
+    running = True
+    while running:
+        if pending:
+            await asyncio.sleep(WRITE_RETRY_DELAY)
+        else:
+            pending.append(await write_queue.get())
+            if pending[0] is not None:
+                await asyncio.sleep(FLUSH_INTERVAL)
+        while not write_queue.empty():
+            pending.append(write_queue.get_nowait())
+        if None in pending:
+            running = False
+            pending = [op for op in pending if op is not None]
+        if await try_flush(pending) is not None:
+            pending = await flush_one_by_one(pending)
+        else:
+            pending = []
+    if pending:
+        logger.error("db_writer: тоқтау кезінде %d операция жазылмай қалды", len(pending))
 
 async def get_balance(telegram_id):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT balance FROM users WHERE telegram_id = ?", (telegram_id,))
-        row = await cursor.fetchone()
-        if row:
-            return row[0]
-        await db.execute("INSERT INTO users (telegram_id, balance) VALUES (?, 0)", (telegram_id,))
-        await db.commit()
-        return 0
+    return balances.get(telegram_id, 0)
 
 async def update_balance(telegram_id, amount):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO users (telegram_id, balance) VALUES (?, ?) ON CONFLICT(telegram_id) DO UPDATE SET balance = balance + ?",
-            (telegram_id, amount, amount)
-        )
-        await db.commit()
+    set_balance(telegram_id, balances.get(telegram_id, 0) + amount)
 
 async def place_bet(telegram_id, amount):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO bets (telegram_id, amount) VALUES (?, ?)", (telegram_id, amount))
-        await db.execute("UPDATE users SET balance = balance - ? WHERE telegram_id = ?", (amount, telegram_id))
-        await db.commit()
+    set_balance(telegram_id, balances.get(telegram_id, 0) - amount)
+    round_bets[telegram_id] = round_bets.get(telegram_id, 0) + amount
+    write_queue.put_nowait(("bet", telegram_id, amount))
 
 async def cashout(telegram_id, multiplier):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT amount FROM bets WHERE telegram_id = ? AND cashed_out = 0", (telegram_id,)
-        )
-        row = await cursor.fetchone()
-        if row:
-            win = row[0] * multiplier
-            await db.execute("UPDATE users SET balance = balance + ? WHERE telegram_id = ?", (win, telegram_id))
-            await db.execute("UPDATE bets SET cashed_out = 1, multiplier = ? WHERE telegram_id = ?", (multiplier, telegram_id))
-            await db.commit()
-            return win
+    amount = round_bets.pop(telegram_id, None)
+    if amount is None:
         return 0
+    win = amount * multiplier
+    set_balance(telegram_id, balances.get(telegram_id, 0) + win)
+    write_queue.put_nowait(("cashout", telegram_id, multiplier))
+    return win
 
-async def reset_bets():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM bets")
-        await db.commit()
+async def settle_round():
+    round_bets.clear()
+    write_queue.put_nowait(("clear",))
 
 # ===================== API =====================
 
@@ -120,34 +227,80 @@ async def do_cashout(data: CashoutRequest):
 
 # ===================== WEBSOCKET =====================
 
-connections = []
+connections = set()
+
+# Әр клиенттің шығыс кезегі: толып кетсе, клиент тым баяу деп есептеледі
+CLIENT_QUEUE_SIZE = 32
+# Баяу клиентті жабу коды: 1013 "Try Again Later" — клиент қайта қосылуы керек
+SLOW_CLIENT_CLOSE_CODE = 1013
 
-async def notify_all(data):
-    to_remove = []
-    for conn in connections:
+def drop_client(ws, close_code=None):
+    connections.discard(ws)
+    task = getattr(ws, "sender_task", None)
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+    if close_code is not None:
+        ws.close_task = asyncio.create_task(close_client(ws, close_code))
+
+async def close_client(ws, code):
+    with contextlib.suppress(Exception):
+        await ws.close(code=code)
+
+async def sender(ws):
+    # Клиентке жіберу тек осы тапсырмада: баяу сокет ойын циклін тоқтатпайды
+    try:
+        while True:
+            payload = await ws.queue.get()
+            await ws.send_text(payload)
+    except Exception:
+        drop_client(ws)
+
+# game_loop хабарламалары: кодтау мен таратуды broadcaster тапсырмасы атқарады
+broadcast_queue = asyncio.Queue()
+
+def notify_all(data):
+    broadcast_queue.put_nowait(data)
+
+async def broadcaster():
+    while True:
+        data = await broadcast_queue.get()
+        # Бір хабарламаның қатесі таратуды тоқтатпауы керек
         try:
-            await conn.send_json(data)
-        except WebSocketDisconnect:
-            to_remove.append(conn)
-    for conn in to_remove:
-        connections.remove(conn)
+            # JSON-ды бір рет қана кодтаймыз (orjson), әр клиенттің кезегіне дайын мәтін кетеді
+            payload = orjson.dumps(data).decode()
+            slow = []
+            for conn in connections:
+                try:
+                    conn.queue.put_nowait(payload)
+                except asyncio.QueueFull:
+                    slow.append(conn)
+            for conn in slow:
+                drop_client(conn, SLOW_CLIENT_CLOSE_CODE)
+        except Exception:
+            logger.exception("broadcaster: хабарламаны тарату сәтсіз: %r", data)
 
 @app.websocket("/ws")
 async def websocket_endpoint(ws: WebSocket):
     await ws.accept()
-    connections.append(ws)
     # Клиентке ағымдағы күйді жіберу
-    await ws.send_json({
+    await ws.send_text(orjson.dumps({
         "type": "state",
         "is_running": game_state["is_running"],
         "multiplier": game_state["multiplier"],
         "time": game_state["time_left"]
-    })
+    }).decode())
+    ws.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+    ws.sender_task = asyncio.create_task(sender(ws))
+    connections.add(ws)
     try:
+        # Оқу жағында күтеміз: клиент жабылса, бірден websocket.disconnect келеді.
+        # Клиенттің мәтін/бинарлы хабарламаларының мазмұны керек емес.
         while True:
-            await asyncio.sleep(10)
-    except WebSocketDisconnect:
-        connections.remove(ws)
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+    finally:
+        drop_client(ws)
 
 # ===================== GAME LOOP =====================
 
@@ -157,42 +310,104 @@ game_state = {
     "is_running": False
 }
 
+# Раунд басында алдын ала есептелетін тик саны
+TICK_BATCH = 1200
+TICK_INTERVAL = 0.1
+# Коэффициент 100 мс сайын өседі, ал клиенттерге осы аралықпен (сек) samples тізімімен кетеді
+BROADCAST_INTERVAL = 0.25
+
+# Бір генератор бүкіл процесске: np.random.* глобал күйіне әр раундта жүгінбейміз
+rng = np.random.default_rng()
+
+def roll_ticks():
+    deltas = np.round(rng.uniform(0.01, 0.05, size=TICK_BATCH), 2)
+    crashes = rng.random(TICK_BATCH) < 0.01
+    return deltas.tolist(), crashes.tolist()
+
 async def game_loop():
     print("Game loop started 🚀")
+    loop = asyncio.get_running_loop()
+    # Тик циклінде глобал/атрибут іздеуін болдырмау үшін жергілікті атаулар
+    sleep, now = asyncio.sleep, loop.time
     while True:
         game_state['time_left'] = 10
         game_state['is_running'] = False
-        await notify_all({"type": "countdown", "time": game_state['time_left']})
+        notify_all({"type": "countdown", "time": game_state['time_left']})
 
+        # Абсолютті дедлайндар: баяу итерация келесі аралықты ұзартпайды (drift жоқ)
+        deadline = now()
         while game_state['time_left'] > 0:
-            await asyncio.sleep(1)
+            deadline += 1
+            await sleep(max(0, deadline - now()))
             game_state['time_left'] -= 1
-            await notify_all({"type": "countdown", "time": game_state['time_left']})
+            notify_all({"type": "countdown", "time": game_state['time_left']})
 
         game_state['is_running'] = True
         multiplier = 1.0
-        await notify_all({"type": "start"})
+        notify_all({"type": "start"})
 
+        deltas, crashes = roll_ticks()
+        tick = 0
+        samples = []
+        deadline = now()
+        next_broadcast = deadline + BROADCAST_INTERVAL
         while True:
-            await asyncio.sleep(0.1)
-            multiplier += round(random.uniform(0.01, 0.05), 2)
+            deadline += TICK_INTERVAL
+            await sleep(max(0, deadline - now()))
+            if tick == TICK_BATCH:
+                deltas, crashes = roll_ticks()
+                tick = 0
+            multiplier += deltas[tick]
             game_state['multiplier'] = multiplier
-            await notify_all({"type": "multiplier", "value": multiplier})
-            if random.random() < 0.01 or multiplier > 100:
+            samples.append(multiplier)
+            if crashes[tick] or multiplier > 100:
                 break
+            tick += 1
+            if deadline >= next_broadcast:
+                notify_all({"type": "multiplier", "value": multiplier, "samples": samples})
+                samples = []
+                next_broadcast += BROADCAST_INTERVAL
 
-        await notify_all({"type": "end", "final_multiplier": multiplier})
-        await reset_bets()
-        await asyncio.sleep(2)
+        notify_all({"type": "end", "final_multiplier": multiplier})
+        await settle_round()
+        await sleep(2)
 
 # ===================== STARTUP / SHUTDOWN =====================
 
 @app.on_event("startup")
 async def startup():
     await init_db()
+    app.state._writer_task = asyncio.create_task(db_writer())
+    app.state._broadcast_task = asyncio.create_task(broadcaster())
     app.state._game_task = asyncio.create_task(game_loop())
 
+async def stop_task(task):
+    # Тапсырма бұрын қатемен құлаған болса да, shutdown әрі қарай жүруі керек
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("%s қатемен тоқтаған", task.get_coro().__name__)
+
 @app.on_event("shutdown")
 async def shutdown():
-    with contextlib.suppress(Exception):
-        app.state._game_task.cancel()
+    # Қандай тапсырма құласа да, баланстарды жазу мен базаны жабу міндетті түрде орындалады
+    try:
+        await stop_task(app.state._game_task)
+        await stop_task(app.state._broadcast_task)
+    finally:
+        try:
+            # Кезекте қалған баланстарды жазып бітіру
+            write_queue.put_nowait(None)
+            await app.state._writer_task
+        except Exception:
+            logger.exception("db_writer тоқтағанда қате")
+        try:
+            # WAL-ды негізгі файлға көшіріп, -wal файлын нөлге дейін қысқарту
+            await app.state.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception:
+            logger.exception("WAL checkpoint сәтсіз")
+        finally:
+            await app.state.db.close()